@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 
+from bisect import bisect_right
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
-from functools import cache, reduce
+from functools import cache
 from itertools import product
 from logging import info, warning, basicConfig
 from os.path import exists, expanduser
+from shutil import copyfileobj
 from string import ascii_letters
-from typing import Iterable, Optional, NewType
+from sys import intern, maxunicode
+from typing import Optional, NewType, Sequence
 from urllib.request import urlopen
 
 from data import custom_dia, diacritics, ligatures, spacing_dia
@@ -16,11 +20,11 @@ from data import custom_dia, diacritics, ligatures, spacing_dia
 basicConfig(level=10)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Chardata:
     name: str
     cat: str
-    deco: str
+    decoded: Optional[tuple[Optional[str], str]]  # see parse_decomposition
     upper: Optional[str]
     lower: Optional[str]
 
@@ -33,30 +37,65 @@ LIGATURE  = "&{}↵"
 COMBINING = Keys("?")
 SPACING   = Keys("|")
 
+# https://github.com/samhocevar/wincompose/blob/7f273636087bd55cbedc178babf5c36375a836f4/src/wincompose/sequences/Key.cs#L55
+KEYNAMES = {
+    "⎄": "Multi_key", " ": "space",
+    "←": "Left", "↑": "Up", "→": "Right", "↓": "Down",
+    "⇱": "Home", "⇲": "End", "⌫": "Backspace", "⌦": "Delete", "↹": "Tab", "↵": "Return",
+    ":": "colon", "<": "less", ">": "greater",
+}
+
 SORT  = True  # this sorts the sequences and saves them in definitions_sorted
 CHECK = True  # enable or disable checking for duplicates and shadows
 
+# categories of characters written with a ◌ in definitions
+MARKS = frozenset(("Mc", "Me", "Mn", "Lm"))
+
 # these can be used with diacritics (["a] => ä) but not as standalone sequences ([a])
 coreltrs = ascii_letters
 
 blocks: list[tuple[int, int, str]] = []
+block_starts: list[int] = []  # the first codepoint of each block, for bisecting
 
 # a dict of user-defined basic sequences
 # example: {"′": ["prime", "pr1"], ...}
-definitions: dict[str, list[Keys]] = defaultdict(list)
+definitions: dict[str, list[Keys]] = {}
 
 # a list of the macros
 # example: ["kʟ̝̊", "kl"]
 macros: list[tuple[str, Keys]] = []
 
-udata: dict[str, Chardata] = defaultdict(lambda: Chardata("UNNAMED", "Cn", "", None, None))
+diacritic_names = frozenset(diacritics)
+# the combining characters in diacritics, without their ◌
+combining_chars = frozenset(k[1:] for k in diacritics if k.startswith("◌") and len(k) == 2)
 
+# these few always seem to cause problems with automatic methods. set them in definitions or
+# custom_dia
+problem_chars = frozenset("Å" "©®🄫🄬" "ºªᵌ" "άέήίόύώΆΈΉΐΊΰΎΌΏ΅" "﹉﹊﹋﹌﹍﹎﹏" "︴🅋")
 
-def escape(*maps: Keys) -> Keys:
 
-    def escape_1(mapp: Keys) -> Keys:
-        return Keys(ESCAPE.format(mapp)) if len(mapp) > 1 and mapp[0] in coreltrs else mapp
+def index_custom_dia() -> dict[str, list[tuple[str, str]]]:
+    index: dict[str, list[tuple[str, str]]] = defaultdict(list)
+    for dia, (decos, chars) in custom_dia.items():
+        for i, char in enumerate(chars):
+            if chars.find(char) == i:  # only the first one counts
+                index[char].append((dia, decos[i]))
+    return dict(index)
+
+
+# custom_dia turned inside out, to look up the diacritics a character can be made with
+# example: {"ƀ": [("STROKE", "b")], ...}
+custom_dia_index = index_custom_dia()
+
+# indexed by codepoint. unassigned codepoints are left as UNNAMED
+udata: list[Chardata] = [Chardata("UNNAMED", "Cn", None, None, None)] * (maxunicode + 1)
+
 
+def escape_1(mapp: Keys) -> Keys:
+    return Keys(ESCAPE.format(mapp)) if len(mapp) > 1 and mapp[0] in coreltrs else mapp
+
+
+def escape(*maps: Keys) -> Keys:
     assert len(maps) > 0
     if len(maps) == 1:
         return escape_1(maps[0])
@@ -67,74 +106,82 @@ def escape(*maps: Keys) -> Keys:
 # udata.normalize doesnt give enough information, so this is a bit more manual
 # https://www.unicode.org/reports/tr44/#Character_Decomposition_Mappings
 # this actually parses some invalid decompositions but who cares (i don't)
-def decompose(char: str) -> tuple[Optional[str], str]:
-    deco = udata[char].deco
-
+def parse_decomposition(deco: str) -> Optional[tuple[Optional[str], str]]:
     # turns "<sus> 0D9E 1F9EF" into ("<sus>", "ඞ🧯"])
     if not deco:
-        return None, char
+        return None
     typ, words = None, deco.split()
     if words[0].startswith("<"):
         typ, *words = words
     return typ, ''.join(chr(int(x, 16)) for x in words)
 
 
+@cache
+def block_of(char: str) -> str:
+    i = bisect_right(block_starts, ord(char)) - 1
+    return blocks[i][2] if i >= 0 and blocks[i][1] >= ord(char) else "not assigned"
+
+
+@cache
 def add_diacritic(keys: Keys, diac: str) -> Keys:
     assert diac in diacritics
     return Keys(diacritics[diac] + keys)
 
 
-def getmap(char: str) -> list[Keys]:
-    if char in coreltrs: return [Keys(char)]
+@cache
+def getmap(char: str) -> tuple[Keys, ...]:
+    if char in coreltrs: return (Keys(char),)
     if '\x21' <= char <= '\x7E' and "ascii" in diacritics:
-        return [add_diacritic(Keys(char), "ascii")]
-    return findmap(char)
+        return (add_diacritic(Keys(char), "ascii"),)
+    return tuple(findmap(char))
 
 
-@cache
-def findmap(char: str) -> list[Keys]:
+def make_diacritic_sequences(diacs: Sequence[str], deco: str) -> list[Keys]:
+    if not diacritic_names.issuperset(diacs): return []
+    # the last diacritic goes first, as if add_diacritic was applied to each one in order
+    prefix = ''.join([diacritics[diac] for diac in reversed(diacs)])
+    keys = [getmap(c) for c in deco]
+    # the same as the general case below, without product and escape for the usual short ones
+    if len(keys) == 1:
+        return [Keys(prefix + escape_1(mapp)) for mapp in keys[0]]
+    if len(keys) == 2:
+        return [Keys(prefix + ESCAPE2.format(escape_1(first) + escape_1(second)))
+                for first in keys[0] for second in keys[1]]
+    return [Keys(prefix + escape(*maps)) for maps in product(*keys)]
 
-    def make_diacritic_sequences(diacs: Iterable[str], deco: str):
-        maps.extend((
-            reduce(add_diacritic, diacs, Keys(escape(*maps)))
-            for maps in product(*map(getmap, deco))
-        ) if all(it in diacritics for it in diacs) else [])
 
-    maps = definitions[char]  # definitions is a defaultdict, this can't fail
+@cache
+def findmap(char: str) -> list[Keys]:
+    maps = list(definitions.get(char, ()))  # a copy, so definitions stays as it was read
 
     # does custom diacritic stuff
-    for dia, values in custom_dia.items():
-        if (index := values[1].find(char)) >= 0:
-            make_diacritic_sequences((dia,), values[0][index])
+    for dia, deco in custom_dia_index.get(char, ()):
+        maps.extend(make_diacritic_sequences((dia,), deco))
 
-    # these few always seem to cause problems with automatic methods. set them in definitions or
-    # custom_dia
-    if char in ("Å" "©®🄫🄬" "ºªᵌ" "άέήίόύώΆΈΉΐΊΰΎΌΏ΅" "﹉﹊﹋﹌﹍﹎﹏" "︴🅋"):
-        return maps
+    if char in problem_chars: return maps
 
     # combining diacritic
-    if "◌" + char in diacritics: maps.append(add_diacritic(COMBINING, "◌" + char))
+    if char in combining_chars: maps.append(add_diacritic(COMBINING, "◌" + char))
 
     # spacing character
     if (index := spacing_dia[1].find(char)) >= 0:
         maps.append(Keys(diacritics["◌" + spacing_dia[0][index]] + SPACING))
 
     # decomposition
-    types, deco = decompose(char)
+    types, deco = udata[ord(char)].decoded or (None, char)
     if types == "<compat>" and deco.startswith("(") and deco.endswith(")"):
-        make_diacritic_sequences(("parens",), deco[1:-1])
+        maps.extend(make_diacritic_sequences(("parens",), deco[1:-1]))
     elif types:
         # compatibility decomposition (does circled letters and superscripts and stuff)
-        make_diacritic_sequences((types,), deco)
+        maps.extend(make_diacritic_sequences((types,), deco))
     elif len(deco) >= 2:
         # canonical decomposition (splits ü into u + ◌̈ into ["u])
-        make_diacritic_sequences(["◌" + x for x in deco[1:]], deco[0])
+        maps.extend(make_diacritic_sequences(["◌" + x for x in deco[1:]], deco[0]))
 
     # makes ligatures
-    if char in ligatures: maps.extend(
-        Keys(LIGATURE.format(''.join(mapp)))
-        for mapp in product(*map(getmap, ligatures[char]))
-    )
+    if char in ligatures:
+        parts = [getmap(c) for c in ligatures[char]]
+        maps.extend([Keys(LIGATURE.format(''.join(mapp))) for mapp in product(*parts)])
 
     return maps
 
@@ -148,28 +195,34 @@ def main() -> None:
         if not exists(path):
             url = 'https://www.unicode.org/Public/UCD/latest/ucd/' + res
             info(f"file {path} not found. downloading from unicode.org...")
-            with urlopen(url) as response, open(path, 'w', encoding="utf-8") as f:
-                f.write(response.read().decode('utf-8'))
-            info("download done")
-        return open(path)
+            with urlopen(url) as response, open(path, 'wb') as f:
+                copyfileobj(response, f, 65536)
+            info(f"download of {res} done")
+        return path
+
+    # both files are downloaded at the same time if they are missing
+    with ThreadPoolExecutor(2) as executor:
+        unicodedata_path, blocks_path = executor.map(request, ["UnicodeData.txt", "Blocks.txt"])
 
-    with request("UnicodeData.txt") as f:
+    with open(unicodedata_path, encoding="utf-8") as f:
         for line in f:
             if line.isspace() or line[0] == "#": continue
             # https://www.unicode.org/reports/tr44/#UnicodeData.txt
             cp, name, cat, _, _, deco, _, _, _, _, _, _, upper, lower, _ = line.split(";")
-            udata[chr(int(cp, 16))] = Chardata(
-                name, cat, deco,
+            udata[int(cp, 16)] = Chardata(
+                name, intern(cat), parse_decomposition(deco),  # there's only a few categories
                 upper=chr(int(upper, 16)) if upper else None,
                 lower=chr(int(lower, 16)) if lower else None,
             )
 
-    with request("Blocks.txt") as f:
+    with open(blocks_path, encoding="utf-8") as f:
         for line in f:
             if line.isspace() or line[0] == "#": continue
             bounds, blockname = line.split("; ", maxsplit=1)
             start, end = bounds.split("..", maxsplit=1)
             blocks.append((int(start, 16), int(end, 16), blockname))
+    blocks.sort()
+    block_starts.extend(start for start, _, _ in blocks)
 
     then = datetime.now()
 
@@ -183,54 +236,61 @@ def main() -> None:
             char, mapp = line.strip("\n").split("::", maxsplit=1)
             char = char[1] if char[0] == "◌" and len(char) > 1 else char
             mapp = Keys(mapp.replace("␣", " "))
-            if len(char) == 2 and udata[char[0]].lower == char[1]:
+            if len(char) == 2 and udata[ord(char[0])].lower == char[1]:
                 # "Ææ::ae" = "Æ::AE" + "æ::ae"
-                definitions[char[0]].append(Keys(mapp.upper()))
-                definitions[char[1]].append(Keys(mapp.lower()))
+                definitions.setdefault(char[0], []).append(Keys(mapp.upper()))
+                definitions.setdefault(char[1], []).append(Keys(mapp.lower()))
             elif len(char) > 1:
                 macros.append((char, mapp))
             else:
-                definitions[char].append(mapp)
+                definitions.setdefault(char, []).append(mapp)
 
     info("reading done")
 
+    # the characters in ranges of UnicodeData.txt (CJK, hangul, private use...) are left as Cn, so
+    # anything with sequences of its own is looked up too
+    extra = {ord(char) for char in (*definitions, *custom_dia_index, *ligatures)}
+    # change this if you're using characters outside BMP/SMP
+    assigned = [cp for cp in range(0x1FFFF) if udata[cp].cat != "Cn" or cp in extra]
+
     # Output definitions to definitions_sorted.txt but, sorted
 
     if SORT:
         info("sorting...")
-        ignore = []
+        ignore = set()
         last_block = "not assigned\n"
         with open(r"definitions_sorted.txt", 'w', encoding="utf-8") as f:
 
             f.write("// this file was automatically generated\n")
             for char, v in sorted(definitions.items(), key=lambda x: ord(x[0][0])):
 
-                data = udata[char]
+                data = udata[ord(char)]
 
-                if last_block != (new := next(
-                        (name for start, end, name in blocks if start <= ord(char) <= end),
-                        "not assigned")):
+                if last_block != (new := block_of(char)):
                     last_block = new
                     f.write("\n// " + new.upper() + "\n")
 
+                low, upp = data.lower or char, data.upper or char
+                # the rules of both cases, if they can be merged into "Ææ::ae"
+                if (low != upp
+                        and char in (upp, low)
+                        and udata[ord(udata[ord(low)].upper or "a")].lower == low):
+                    lrules, urules = definitions.get(low, ()), definitions.get(upp, ())
+                else:
+                    lrules = urules = ()
+                urules_lower = [urule.lower() for urule in urules]
+                shown = "◌" + char if data.cat in MARKS else char
+
                 for ruleno, rule in enumerate(sorted(v)):
                     if rule.lower() in ignore: continue
-                    low, upp = data.lower or char, data.upper or char
-                    if (low != upp
-                            and char in (upp, low)
-                            and udata[udata[low].upper or "a"].lower == low):
-                        try:  # XXX: this is Bad and Ugly
-                            lrule = definitions[low][ruleno]
-                            urule = definitions[upp][ruleno]
-                        except IndexError: pass
-                        else:
-                            if lrule == urule.lower():
-                                ignore.append(lrule)
-                                f.write(upp + low + "::" + lrule.replace(' ', '␣') + "\n")
-                                continue
-
-                    f.write(("◌" if data.cat in ("Mc", "Me", "Mn", "Lm") else "")
-                            + char + "::" + rule.replace(' ', '␣') + "\n")
+                    if ruleno < len(lrules) and ruleno < len(urules):
+                        lrule = lrules[ruleno]
+                        if lrule == urules_lower[ruleno]:
+                            ignore.add(lrule)
+                            f.write(upp + low + "::" + lrule.replace(' ', '␣') + "\n")
+                            continue
+
+                    f.write(shown + "::" + rule.replace(' ', '␣') + "\n")
 
             f.write("\n// MACROS\n\n")
             for text, rule in macros:
@@ -244,40 +304,40 @@ def main() -> None:
     with open(expanduser("~/.XCompose"), 'w', encoding='utf-8') as f:
 
         def add_rule(keys: Keys, result: str, comment: str) -> None:
-            # https://github.com/samhocevar/wincompose/blob/7f273636087bd55cbedc178babf5c36375a836f4/src/wincompose/sequences/Key.cs#L55
-            replacements = {
-                "⎄": "Multi_key", " ": "space",
-                "←": "Left", "↑": "Up", "→": "Right", "↓": "Down",
-                "⇱": "Home", "⇲": "End", "⌫": "Backspace", "⌦": "Delete", "↹": "Tab", "↵": "Return",
-                ":": "colon", "<": "less", ">": "greater",
-            }
-            f.write("<Multi_key> <{}> : \"{}\" #{}\n".format(
-                '> <'.join(replacements.get(i, i) for i in str(keys)),
-                result.replace(r'"', r'\0x0022'),  # \" doesnt work for some reason
-                comment))
-            if CHECK and keys in rules: warning(f"[{keys}] found more than once ({comment})")
+            names = '> <'.join([KEYNAMES.get(i, i) for i in keys])
+            result = result.replace(r'"', r'\0x0022')  # \" doesnt work for some reason
+            lines.append(f"<Multi_key> <{names}> : \"{result}\" #{comment}\n")
+            if CHECK and keys in rules_set: warning(f"[{keys}] found more than once ({comment})")
             rules.append(keys)
+            rules_set.add(keys)
 
+        lines: list[str] = []  # written all at once at the end
         rules: list[Keys] = []
+        rules_set: set[Keys] = set()
 
-        for cp in range(0x1FFFF):  # change this if you're using characters outside BMP/SMP
-            try:
-                charname = udata[chr(cp)].name
-            except KeyError:
-                # charname = "UNNAMED"
-                pass
-            else:  # note that this means that only characters with name will be processed
-                for rule in findmap(chr(cp)): add_rule(rule, chr(cp), charname)
+        for cp in assigned:
+            char, charname = chr(cp), udata[cp].name
+            for rule in findmap(char): add_rule(rule, char, charname)
 
         info("writing macros...")
         for text, rule in macros:
             add_rule(rule, text, "macro")
 
+        f.writelines(lines)
+
         if CHECK:
             info("looking for shadows...")
+            # a trie of every rule, one key per level. a None key marks the end of a rule
+            trie: dict = {}
+            for rule in rules_set:
+                node = trie
+                for key in rule: node = node.setdefault(key, {})
+                node[None] = None
             for rule in rules:
-                for n in range(1, len(rule)):  # should this be `enumerate`?
-                    if rule[:n] in rules: warning(f"[{rule[:n]}] shadows [{rule}]")
+                node = trie
+                for n, key in enumerate(rule[:-1], 1):
+                    node = node[key]
+                    if None in node: warning(f"[{rule[:n]}] shadows [{rule}]")
 
         info(f"done! {datetime.now() - then}")
 